@@ -17,26 +17,49 @@
 #
 # Dependencies:
 #   pip install --upgrade beautifulsoup4
+#   pip install --upgrade lxml
 #   pip install --upgrade tabulate
 #   pip install --upgrade azure-cognitiveservices-language-textanalytics
-#   pip install --upgrade matplotlib
+#   pip install --upgrade matplotlib (only needed for the sentiment plot)
 
 import datetime
 import json
 import os
 import re
 from collections import Counter
-from collections import OrderedDict
-from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import cached_property
 from statistics import mean
 from time import sleep
-from typing import Dict, List
+from typing import Dict, Iterable, List, Tuple
 
-import matplotlib.pyplot as plt
 from azure.cognitiveservices.language.textanalytics import TextAnalyticsClient
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, FeatureNotFound
 from tabulate import tabulate
 from msrest.authentication import CognitiveServicesCredentials
+from msrest.exceptions import HttpOperationError
+
+# Maximum number of documents per Azure text analytics request
+ANALYTICS_BATCH_SIZE = 10
+# Maximum number of concurrent Azure text analytics requests
+ANALYTICS_MAX_WORKERS = 4
+# Number of times to retry an Azure text analytics request that was throttled
+ANALYTICS_MAX_RETRIES = 5
+
+_IS_MEMBER_RE = re.compile(r"^(This user is|You are) a member of the .* organization\.$")
+_REACTION_COUNT_RE = re.compile(r"\D+")
+
+# Emojis to display in place of GitHub reaction names
+_REACTION_EMOJIS = {
+    "THUMBS_UP": "👍",
+    "THUMBS_DOWN": "👎",
+    "HEART": "❤️",
+    "LAUGH": "😄️",
+    "HOORAY": "🎉",
+    "CONFUSED": "😕",
+    "ROCKET": "🚀",
+    "EYES": "👀",
+}
 
 class GitHubCommentData:
     """Data about a GitHub comment in an issue."""
@@ -47,16 +70,6 @@ class GitHubCommentData:
         self.key_phrases = key_phrases
 
 
-    def get_serializable(self) -> Dict:
-        """Returns a serialization-friendly version of the GitHubCommentData instance."""
-        result = {}
-        result["comment_text"] = self.comment_text
-        result["comment_reactions"] = self.comment_reactions
-        result["sentiment_score"] = self.sentiment_score
-        result["key_phrases"] = self.key_phrases
-        return result
-
-
     def __str__(self):
         return "GitHub comment: %s" % (self.comment_text[:50])
 
@@ -66,64 +79,48 @@ class GitHubCommentData:
 
 
 class GitHubUserData:
-    """Stores info about a GitHub user participating in an issue."""
+    """Stores info about a GitHub user participating in an issue.
+
+       reaction_totals and key_phrase_totals are running totals that must be updated whenever a comment is added to comment_details.
+       The average sentiment score is computed on first use and cached, so comment_details shouldn't be modified after then.
+    """
     def __init__(self, is_issue_author: bool, is_member: bool):
         self.is_issue_author = is_issue_author
         self.is_member = is_member
         self.comment_count = 0
         self.mention_count = 0
         self.comment_details = []
+        self.reaction_totals: Counter = Counter()
+        self.key_phrase_totals: Counter = Counter()
 
 
-    def get_key_phrases_counter(self, excluded_key_phrases: List[str]) -> Counter:
+    def get_key_phrases_counter(self, excluded_key_phrases: Iterable[str]) -> Counter:
         """Returns a Counter instance containing all key phrases from all of the user's comments."""
-        # Get list of key_phrase lists, dropping empty lists
-        result = [comment_detail.key_phrases for comment_detail in self.comment_details if comment_detail.key_phrases]
-        # Flatten and count list
-        return Counter([key_phrase for key_phrase_list in result for key_phrase in key_phrase_list if key_phrase not in excluded_key_phrases])
+        excluded_key_phrases = frozenset(excluded_key_phrases)
+        return Counter({key_phrase:count for (key_phrase, count) in self.key_phrase_totals.items() if key_phrase not in excluded_key_phrases})
 
 
     def get_reactions_summary(self, use_emojis: bool = False):
         """Returns a sorted list of summed reaction counts for all of the user's comments."""
-        # Get list of reactions lists, dropping empty lists
-        result = [comment_detail.comment_reactions for comment_detail in self.comment_details if comment_detail.comment_reactions]
-        # Flatten list and sort so that it can be summed using groupby
-        result = sorted([reaction for reaction_list in result for reaction in reaction_list])
-        # Sum flattened list
-        result = [(k, sum(count for _, count in v)) for k, v in groupby(result, lambda x : x[0])]
-        # Sort flattened summed list by descending number of reactions
-        result = sorted(result, key = lambda x : x[1], reverse = True)
+        # Sort summed reactions by descending number of reactions, then by name
+        result = sorted(self.reaction_totals.items(), key = lambda x : (-x[1], x[0]))
 
         # Not all terminals support rendering emojis, so optionally substitute
         if use_emojis:
-            reaction_emojis = {}
-            reaction_emojis["THUMBS_UP"] = "👍"
-            reaction_emojis["THUMBS_DOWN"] = "👎"
-            reaction_emojis["HEART"] = "❤️"
-            reaction_emojis["LAUGH"] = "😄️"
-            reaction_emojis["HOORAY"] = "🎉"
-            reaction_emojis["CONFUSED"] = "😕"
-            reaction_emojis["ROCKET"] = "🚀"
-            reaction_emojis["EYES"] = "👀"
-            result = [(reaction[0].replace(reaction[0], reaction_emojis[reaction[0]]), reaction[1]) for reaction in result]
+            result = [(_REACTION_EMOJIS.get(reaction, reaction), count) for (reaction, count) in result]
 
         return result
 
-    def get_average_sentiment_score(self) -> float:
-        """Returns an average sentiment score for all of the user's comments, or -1 if the user did not comment."""
+    @cached_property
+    def _average_sentiment_score(self) -> float:
         averages = [comment_detail.sentiment_score for comment_detail in self.comment_details]
         return mean(averages) if averages else -1
 
 
-    def get_serializable(self) -> Dict:
-        """Returns a serialization-friendly version of the GitHubUserData instance."""
-        result = {}
-        result["is_issue_author"] = self.is_issue_author
-        result["is_member"] = self.is_member
-        result["comment_count"] = self.comment_count
-        result["mention_count"] = self.mention_count
-        result["comment_details"] = [comment.get_serializable() for comment in self.comment_details]
-        return result
+    def get_average_sentiment_score(self) -> float:
+        """Returns an average sentiment score for all of the user's comments, or -1 if the user did not comment."""
+        return self._average_sentiment_score
+
 
     def __str__(self):
         return "GitHub user: is_issue_author:%s; is_member:%s; comment_count:%s, mention_count:%s, comment_details.count:%s" % (str(self.is_issue_author), str(self.is_member), self.comment_count, self.mention_count, len(self.comment_details))
@@ -141,92 +138,127 @@ class GitHubIssueData:
     def __init__(self, file_name: str, analytics_config_filename: str = None):
         self.sentiments: List[float] = []
         self._analytics_config_filename:str = analytics_config_filename
-        with open(file_name, 'r', encoding="utf8") as file:
-            self._soup: BeautifulSoup = BeautifulSoup(file.read(), "html.parser")
+        # Pass the file itself to the parser rather than holding on to a separate copy of the page source
+        # Open as bytes so that the parser can decode the page itself using its declared charset rather than decoding it separately first
+        with open(file_name, 'rb') as file:
+            try:
+                # Prefer the much faster lxml parser, falling back to the built-in parser if lxml isn't installed
+                self._soup: BeautifulSoup = BeautifulSoup(file, "lxml")
+            except FeatureNotFound:
+                self._soup = BeautifulSoup(file, "html.parser")
         self.title: str = self._soup.title.string
-        self._comments = self._soup("div", class_="unminimized-comment")
-        self._original_post = self._comments.pop(0)  # Remove original post from comments list
-        self.comment_count: int = len(self._comments) # Get comment count after popping original post
+        comments = self._soup("div", class_="unminimized-comment")
+        self._original_post = comments[0]
+        self._comments = comments[1:] # Exclude original post from comments list
+        self.comment_count: int = len(self._comments)
         self.users = self._populate_user_data()
 
 
     def _populate_user_data(self):
         users = {}
 
-        is_member_regex = re.compile(r"^(This user is|You are) a member of the .* organization\.$")
-        reaction_count_regex = re.compile(r"\D*")
-
-        if self._analytics_config_filename:
-            with open(self._analytics_config_filename, "r") as file:
-                azure_config = json.load(file)
-            text_analytics = TextAnalyticsClient(endpoint = azure_config["cognitive_services"]["endpoint"], credentials = CognitiveServicesCredentials(azure_config["cognitive_services"]["key"]))
-
+        # Collect comment data first so that Azure analytics can be run on batches of comments rather than one comment at a time
+        comment_data = []
         for comment in self._comments:
-            user = comment.find("a", class_="author").get_text()
+            user = comment.select_one("a.author").get_text()
 
             # Add user to list if not already present
             if user not in users:
                 users[user] = GitHubUserData(
-                    is_issue_author = True if comment.find("span",attrs={"aria-label": "You are the author of this issue."}) else False,
-                    is_member = True if comment.find("span",attrs={"aria-label": is_member_regex}) else False,
+                    is_issue_author = True if comment.select_one('span[aria-label="You are the author of this issue."]') else False,
+                    is_member = True if comment.find("span",attrs={"aria-label": _IS_MEMBER_RE}) else False,
                 )
 
-            user_data = users[user]
-
-            # Increment comment count for user
-            user_data.comment_count += 1
-
-            comment_text = comment.find("textarea",attrs={"name": "issue[body]"}).get_text()
-
-            # Default to neutral sentiment if Azure analytics aren't run
-            sentiment_score = 0.5
-            # Default to empty key phrases if Azure analytics aren't run
-            key_phrases = []
-
-            # Run Azure analytics if a config file was supplied
-            if self._analytics_config_filename:
-                sleep(0.05) # Throttle Azure API requests - not sure if SDK also does throttling
-                # Create shared request payload
-                comment_text_analysis_request_payload = [
-                    {
-                        "id": "1",
-                        "language": "en", # Assume en
-                        "text": comment_text[:5000] # Truncate to ensure under 5120 total request character limit
-                    }
-                ]
-                # Do sentiment analysis
-                sentiment_response = text_analytics.sentiment(documents = comment_text_analysis_request_payload)
-                sentiment_score = sentiment_response.documents[0].score
-                # Do key phrase extraction
-                key_phrase_response = text_analytics.key_phrases(documents = comment_text_analysis_request_payload)
-                key_phrases = key_phrase_response.documents[0].key_phrases
+            comment_text = comment.select_one('textarea[name="issue[body]"]').get_text()
 
             # Get list of comment reactions, if any
-            comment_reactions_source = comment.find("div",class_="has-reactions")
+            comment_reactions_source = comment.select_one("div.has-reactions")
             comment_reactions = []
             if comment_reactions_source:
                 for button in comment_reactions_source("button"):
-                    reaction_count = re.sub(reaction_count_regex, "", button.get_text())
+                    reaction_count = _REACTION_COUNT_RE.sub("", button.get_text())
                     if reaction_count:
-                        comment_reactions.append((button["value"].split(" ", 1)[0], int(reaction_count)))
+                        comment_reactions.append((button.get("value", "").partition(" ")[0], int(reaction_count)))
+
+            comment_data.append((user, comment_text, comment_reactions))
+
+        # Run Azure analytics if a config file was supplied
+        if self._analytics_config_filename:
+            text_analytics_results = self._get_text_analytics([comment_text for (_, comment_text, _) in comment_data])
+        else:
+            # Default to neutral sentiment and empty key phrases if Azure analytics aren't run
+            text_analytics_results = [(0.5, [])] * len(comment_data)
+
+        for (user, comment_text, comment_reactions), (sentiment_score, key_phrases) in zip(comment_data, text_analytics_results):
+            user_data = users[user]
+
+            # Increment comment count for user
+            user_data.comment_count += 1
 
             # Add comment details
-            #user_data.comment_details.append((comment_text, comment_reactions, sentiment_score, key_phrases))
             user_data.comment_details.append(GitHubCommentData(comment_text, comment_reactions, sentiment_score, key_phrases))
 
+            # Keep running totals of the user's reactions and key phrases
+            for reaction, reaction_count in comment_reactions:
+                user_data.reaction_totals[reaction] += reaction_count
+            user_data.key_phrase_totals.update(key_phrases)
+
             # Keep chronological list of sentiments
             self.sentiments.append(sentiment_score)
 
         # Get count of mentions and update user collection
         # We do this after adding comment data for users to ensure that organization membership status is populated where available
-        mentioned_counts = {user:int(doubled_count / 2) for (user, doubled_count) in Counter(user.get_text()[1:] for user in self._soup("a", class_="user-mention")).items()} # trim leading '@' from user names and divide counts by 2 because GitHub pages keep 2 copies of each
-        for user, mention_count in mentioned_counts.items():
+        # Mention links usually contain just the user name text, so use .string to avoid walking descendants where possible
+        mentioned_counts = Counter((mention.string or mention.get_text())[1:] for mention in self._soup("a", class_="user-mention")) # trim leading '@' from user names
+        for user, doubled_count in mentioned_counts.items():
             # Don't readily know if users who were mentioned but never commented are members or not, so just assume not
-            users.setdefault(user, GitHubUserData(False, False)).mention_count = mention_count
+            if user not in users:
+                users[user] = GitHubUserData(False, False)
+            # Divide counts by 2 because GitHub pages keep 2 copies of each
+            users[user].mention_count = doubled_count >> 1
 
         return users
 
 
+    def _get_text_analytics(self, comment_texts: List[str]) -> List[Tuple[float, List[str]]]:
+        """Returns a (sentiment_score, key_phrases) tuple for each of comment_texts using Azure Cognitive Services text analytics."""
+        with open(self._analytics_config_filename, "r") as file:
+            azure_config = json.load(file)
+        text_analytics = TextAnalyticsClient(endpoint = azure_config["cognitive_services"]["endpoint"], credentials = CognitiveServicesCredentials(azure_config["cognitive_services"]["key"]))
+
+        # Truncate to ensure under 5120 character limit per document
+        truncated_texts = [comment_text[:5000] for comment_text in comment_texts]
+        # Only analyze each distinct non-empty text once, since short replies like "+1" are often repeated
+        unique_texts = list(dict.fromkeys(text for text in truncated_texts if text.strip()))
+
+        # Create shared request payloads
+        batches = [
+            [
+                {
+                    "id": str(i),
+                    "language": "en", # Assume en
+                    "text": unique_texts[i]
+                }
+                for i in range(batch_start, min(batch_start + ANALYTICS_BATCH_SIZE, len(unique_texts)))
+            ]
+            for batch_start in range(0, len(unique_texts), ANALYTICS_BATCH_SIZE)
+        ]
+
+        # Default to neutral sentiment and empty key phrases for empty texts and any documents that Azure fails to analyze
+        sentiment_scores = {}
+        key_phrases = {}
+        # Requests are I/O bound, so run sentiment analysis and key phrase extraction for all batches concurrently
+        with ThreadPoolExecutor(max_workers = ANALYTICS_MAX_WORKERS) as executor:
+            sentiment_futures = [executor.submit(_request_with_backoff, text_analytics.sentiment, batch) for batch in batches]
+            key_phrase_futures = [executor.submit(_request_with_backoff, text_analytics.key_phrases, batch) for batch in batches]
+            for future in as_completed(sentiment_futures):
+                sentiment_scores.update((unique_texts[int(document.id)], document.score) for document in future.result().documents)
+            for future in as_completed(key_phrase_futures):
+                key_phrases.update((unique_texts[int(document.id)], document.key_phrases) for document in future.result().documents)
+
+        return [(sentiment_scores.get(text, 0.5), key_phrases.get(text, [])) for text in truncated_texts]
+
+
     def get_participant_count_summary(self):
         return self._soup.find("div",class_="participation").div.string.strip()
 
@@ -238,11 +270,14 @@ class GitHubIssueData:
 
            Excludes any key phrases in excluded_key_phrases.
         """
-        excluded_phrases = excluded_key_phrases + list(self.users.keys()) if exclude_user_names else []
+        excluded_phrases = frozenset(excluded_key_phrases) | (frozenset(self.users.keys()) if exclude_user_names else frozenset())
 
+        # Sum all users' key phrase totals into a single Counter, then drop excluded phrases once
         total_count = Counter()
         for user in self.users.values():
-            total_count += user.get_key_phrases_counter(excluded_key_phrases = excluded_phrases)
+            total_count.update(user.key_phrase_totals)
+        for excluded_phrase in excluded_phrases:
+            del total_count[excluded_phrase]
 
         return tabulate(
             total_count.most_common(key_phrase_count),
@@ -252,10 +287,10 @@ class GitHubIssueData:
     def get_tabulated_user_interaction_data(self, use_emojis: bool = False):
         """Returns a sorted table of interesting user interaction data from the issue's comments."""
         # Sort users
-        sorted_users = OrderedDict(sorted(
+        sorted_users = sorted(
             self.users.items(),
             key=lambda u: (u[1].comment_count, u[1].mention_count, u[0]),
-            reverse=True))
+            reverse=True)
 
         # Return tabulated list of interesting user info
         return tabulate(((
@@ -265,20 +300,10 @@ class GitHubIssueData:
             val.comment_count,
             val.mention_count,
             val.get_average_sentiment_score(),
-            val.get_reactions_summary(use_emojis)) for (key,val) in sorted_users.items()),
+            val.get_reactions_summary(use_emojis)) for (key,val) in sorted_users),
             headers=["", "", "User", "Comment count", "Times @mentioned", "Avg Sentiment", "Reactions"])
 
 
-    def get_serializable(self) -> Dict:
-        """Returns a serialization-friendly version of the GitHubIssueData instance."""
-        result = {}
-        result["title"] = self.title
-        result["comment_count"] = self.comment_count
-        result["sentiments"] = self.sentiments
-        result["users"] = {name:user_data.get_serializable() for name, user_data in self.users.items()}
-        return result
-
-
     def __str__(self):
         return "GitHub issue: %s" % (self.title)
 
@@ -287,6 +312,24 @@ class GitHubIssueData:
         return "GitHubIssue: %s" % (self.title)
 
 
+def _request_with_backoff(request, documents):
+    """Calls an Azure text analytics request function with documents, retrying with exponential backoff if the request is throttled."""
+    for attempt in range(ANALYTICS_MAX_RETRIES):
+        try:
+            return request(documents = documents)
+        except HttpOperationError as error:
+            # Only retry "429 Too Many Requests" responses
+            if error.response is None or error.response.status_code != 429:
+                raise
+            sleep(0.5 * 2 ** attempt)
+    return request(documents = documents)
+
+
+def _get_serializable(obj) -> Dict:
+    """Returns the public attributes of obj for json serialization, skipping private ones like parsed HTML and cached values."""
+    return {name:value for (name, value) in vars(obj).items() if not name.startswith("_")}
+
+
 def analyze_github_comments(issue: GitHubIssueData, key_phrase_count: int = 50, excluded_key_phrases : List[str] = [], print_summary: bool = True, show_sentiment_plot: bool = True, output_filename: str = None):
     """Prints analysis of a GitHub issue and comments."""
 
@@ -300,20 +343,26 @@ def analyze_github_comments(issue: GitHubIssueData, key_phrase_count: int = 50,
         "Excludes keyphrases: %s" % excluded_key_phrases,
     ]
 
+    summary_text = "\n\n".join(output_sections)
+
     if print_summary:
-        print("\n\n".join(output_sections))
+        print(summary_text)
+
+    if show_sentiment_plot or output_filename:
+        # Only import matplotlib when a plot is needed since it's slow to load
+        import matplotlib.pyplot as plt
 
-    # Plot comment sentiments over time
-    plt.plot(issue.sentiments)
-    plt.title("Sentiment over time")
-    plt.ylabel("Sentiment")
-    plt.xlabel("Comment")
-    sentiment_figure = plt.gcf()
+        # Plot comment sentiments over time
+        plt.plot(issue.sentiments)
+        plt.title("Sentiment over time")
+        plt.ylabel("Sentiment")
+        plt.xlabel("Comment")
+        sentiment_figure = plt.gcf()
 
     if output_filename:
         # Write analysis summary to txt file
         with open(output_filename, "w", encoding="utf8") as file:
-            file.write("\n".join(output_sections))
+            file.write(summary_text)
             print("Saved detailed results to %s" % (os.path.abspath(output_filename)))
         # Write sentiment plot to png file
         plot_filename = output_filename + "-sentiment_plot.png"
@@ -322,7 +371,7 @@ def analyze_github_comments(issue: GitHubIssueData, key_phrase_count: int = 50,
         # Write raw data to json file
         raw_json_filename = output_filename + "-raw_output.json"
         with open(raw_json_filename, "w", encoding="utf8") as file:
-            json.dump(issue.get_serializable(), file, indent = 2)
+            json.dump(issue, file, default = _get_serializable, indent = 2)
             print("Saved raw json output to %s" % (os.path.abspath(raw_json_filename)))
 
     if show_sentiment_plot: